@@ -1,46 +1,205 @@
 import streamlit as st
-import json
-import copy
+import ahocorasick
+import msgspec
+import orjson
+import pandas as pd
+import re
+
+# Below this many PIIs, plain substring checks beat building an automaton.
+AHOCORASICK_MIN_PIIS = 8
+
+# Top-level JSONL fields that Entry stores as typed attributes.
+ENTRY_FIELDS = ("id", "context", "question", "piis")
+
+# Highlight markup for high / low relevance PIIs; only the PII is interpolated.
+HIGH_SPAN = "<span style='background-color:#4a90e2; color:white; padding:2px 4px; border-radius:4px'>{}</span>"
+LOW_SPAN = HIGH_SPAN.replace("#4a90e2", "#ffa726")
+
+# ===== Data model =====
+
+class Entry(msgspec.Struct, gc=False):
+    """One annotation entry as held in session state.
+
+    PIIs are parallel columns (on disk they are a single ``piis`` dict) and
+    ``pii_order`` caches their indices longest value first, for highlighting.
+    Unknown top-level fields are kept in ``extra``. ``key_order`` is only set
+    when the record's keys are not in the order ``record_keys`` gives.
+    Ids are stored exactly as decoded, so string and integer ids both round-trip.
+    """
+    context: str
+    question: str
+    pii_values: list[str]
+    pii_types: list[str]
+    pii_relevances: list[str]
+    pii_order: list[int] = []
+    id: str | int | None = None
+    extra: dict | None = None
+    key_order: tuple | None = None
+
 
 # ===== Utility functions =====
 
-def highlight_pii(text, piis):
-    """Highlight PII values in text with colored spans."""
-    for pii, info in sorted(piis.items(), key=lambda x: -len(x[0])):
-        color = "#4a90e2" if info["relevance"] == "high" else "#ffa726"
-        text = text.replace(
-            pii,
-            f"<span style='background-color:{color}; color:white; padding:2px 4px; border-radius:4px'>{pii}</span>"
-        )
-    return text
+@st.cache_data(show_spinner=False, max_entries=512)
+def highlight_pii(text, piis_items):
+    """Highlight PII values in text with colored spans.
+
+    ``piis_items`` is a tuple of ``(pii, relevance)`` pairs, longest PII first
+    (see ``sort_pii_order``), so the result can be cached across reruns. All PIIs
+    are matched in one pass in that order, so a PII that is a substring of another
+    one (or of the inserted markup) is never highlighted twice.
+    """
+    spans = {
+        pii: HIGH_SPAN if relevance == "high" else LOW_SPAN
+        for pii, relevance in piis_items
+    }
+    values = [pii for pii in spans if pii]
+    if not values:
+        return text
+    pattern = re.compile("|".join(map(re.escape, values)))
+    return pattern.sub(lambda m: spans[m.group(0)].format(m.group(0)), text)
+
+
+def to_soa(record):
+    """Build an Entry from an on-disk JSONL record."""
+    piis = record["piis"]
+    extra = {key: value for key, value in record.items() if key not in ENTRY_FIELDS}
+    entry = Entry(
+        context=record["context"],
+        question=record["question"],
+        pii_values=list(piis),
+        pii_types=[info["type"] for info in piis.values()],
+        pii_relevances=[info["relevance"] for info in piis.values()],
+        id=record.get("id"),
+        extra=extra or None,
+    )
+    if list(record) != record_keys(entry):
+        entry.key_order = tuple(record)
+    return sort_pii_order(entry)
+
+
+def record_keys(entry):
+    """Default on-disk key order: id (if set), context, question, piis, then extras."""
+    keys = ["id"] if entry.id is not None else []
+    keys += ["context", "question", "piis"]
+    if entry.extra:
+        keys += entry.extra
+    return keys
+
+
+def sort_pii_order(entry):
+    """Cache PII indices longest value first; call whenever pii_values changes."""
+    values = entry.pii_values
+    entry.pii_order = sorted(range(len(values)), key=lambda i: len(values[i]), reverse=True)
+    return entry
+
+
+def from_soa(entry):
+    """Inverse of to_soa: rebuild the on-disk record, in its original key order."""
+    fields = dict(entry.extra) if entry.extra else {}
+    fields["id"] = entry.id
+    fields["context"] = entry.context
+    fields["question"] = entry.question
+    fields["piis"] = {
+        pii: {"type": pii_type, "relevance": relevance}
+        for pii, pii_type, relevance in zip(entry.pii_values, entry.pii_types, entry.pii_relevances)
+    }
+    return {key: fields[key] for key in entry.key_order or record_keys(entry)}
+
+
+def parse_jsonl(raw):
+    """Parse JSONL bytes into a fresh list of entries, skipping blank lines."""
+    return [to_soa(orjson.loads(line)) for line in raw.split(b"\n") if line.strip()]
 
 
 def save_current_edits(idx, entries):
-    """Synchronize current UI values back into entries[idx]."""
+    """Synchronize current UI values back into entries[idx].
+
+    Returns early, without rebuilding anything, when no widget differs from the
+    stored entry (e.g. a plain navigation click).
+    """
+    get = st.session_state.get
     entry = entries[idx]
-    entry["context"] = st.session_state.get(f"context_{idx}", entry["context"])
-    entry["question"] = st.session_state.get(f"question_{idx}", entry["question"])
-
-    updated_piis = {}
-    for pii, info in entry["piis"].items():
-        t_key = f"type_{idx}_{pii}"
-        r_key = f"rel_{idx}_{pii}"
-        new_type = st.session_state.get(t_key, info["type"])
-        new_rel = st.session_state.get(r_key, info["relevance"])
-        updated_piis[pii] = {"type": new_type, "relevance": new_rel}
-
-    entry["piis"] = updated_piis
+    context = get(f"context_{idx}", entry.context)
+    question = get(f"question_{idx}", entry.question)
+    types, relevances = entry.pii_types, entry.pii_relevances
+    # The PII table only reports edited cells, keyed by row position.
+    editor_state = get(f"piis_{idx}")
+    edited_rows = editor_state["edited_rows"] if editor_state else {}
+    if (
+        context == entry.context
+        and question == entry.question
+        and all(
+            changes.get("type", types[row]) == types[row]
+            and changes.get("relevance", relevances[row]) == relevances[row]
+            for row, changes in edited_rows.items()
+        )
+    ):
+        return
+
+    entry.context = context
+    entry.question = question
+    # PII values never change here, so write the edited cells in place.
+    for row, changes in edited_rows.items():
+        types[row] = changes.get("type", types[row])
+        relevances[row] = changes.get("relevance", relevances[row])
     entries[idx] = entry
     st.session_state.entries = entries
+    mark_dirty()
+
+
+def mark_dirty():
+    """Record that entries changed so the download payload is rebuilt."""
+    st.session_state.dirty_version = st.session_state.get("dirty_version", 0) + 1
+
+
+def download_payload(entries):
+    """Return a callable that builds the on-disk JSONL bytes when Download is clicked.
+
+    Streamlit runs the callable on its own thread, so it only touches the objects
+    captured here and reuses the previous payload until the entries change.
+    """
+    cache = st.session_state.setdefault("download_cache", {})
+    version = st.session_state.dirty_version
+
+    def build():
+        if cache.get("version") != version:
+            # Encode straight into one buffer instead of a list of lines plus a join.
+            buf = bytearray()
+            for e in entries:
+                buf += orjson.dumps(from_soa(e), option=orjson.OPT_APPEND_NEWLINE)
+            cache["data"] = bytes(buf)
+            cache["version"] = version
+        return cache["data"]
+
+    return build
 
 
 def refresh_pii_from_context(entry):
     """Keep only PIIs that still appear in context text."""
-    context = entry["context"]
-    entry["piis"] = {
-        pii: info for pii, info in entry["piis"].items() if pii in context
-    }
-    return entry
+    context = entry.context
+    values = entry.pii_values
+    if len(values) < AHOCORASICK_MIN_PIIS:
+        found = {pii for pii in values if pii in context}
+    else:
+        # One linear scan over the context finds every PII at once.
+        automaton = ahocorasick.Automaton()
+        for pii in values:
+            if pii:
+                automaton.add_word(pii, pii)
+        automaton.make_automaton()
+        found = {pii for _, pii in automaton.iter(context)}
+        # The automaton cannot hold "", which (like `"" in context`) always matches.
+        if "" in values:
+            found.add("")
+    if len(found) == len(values):
+        return entry
+
+    keep = [i for i, pii in enumerate(values) if pii in found]
+    types, relevances = entry.pii_types, entry.pii_relevances
+    entry.pii_values = [values[i] for i in keep]
+    entry.pii_types = [types[i] for i in keep]
+    entry.pii_relevances = [relevances[i] for i in keep]
+    return sort_pii_order(entry)
 
 
 # ===== Streamlit app =====
@@ -56,22 +215,23 @@ PII_TYPES = ["age", "appearance", "datetime", "belief", "code", "contact", "educ
 
 # ---------- Load ----------
 if uploaded_file and "entries" not in st.session_state:
-    lines = uploaded_file.getvalue().decode("utf-8").splitlines()
-    entries = [json.loads(line) for line in lines]
-    st.session_state.entries = copy.deepcopy(entries)
-    st.session_state.original_entries = copy.deepcopy(entries)
+    raw = uploaded_file.getvalue()
+    # Keep the original as the uploaded bytes; it is only parsed again on "Load Original".
+    st.session_state.entries = parse_jsonl(raw)
+    st.session_state.original_entries_bytes = raw
     st.session_state.current_idx = 0
 
 if "entries" in st.session_state:
     entries = st.session_state.entries
     idx = st.session_state.current_idx
     entry = entries[idx]
+    st.session_state.setdefault("dirty_version", 0)
 
     # ---------- Header ----------
-    if "id" in entry:
+    if entry.id is not None:
         st.markdown(
             f"### Entry {idx + 1} / {len(entries)} "
-            f"<span style='color:gray;'>(<code>{entry['id']}</code>)</span>",
+            f"<span style='color:gray;'>(<code>{entry.id}</code>)</span>",
             unsafe_allow_html=True
         )
     else:
@@ -103,7 +263,7 @@ if "entries" in st.session_state:
     # ---------- Context (editable) ----------
     context_key = f"context_{idx}"
     if context_key not in st.session_state:
-        st.session_state[context_key] = entry["context"]
+        st.session_state[context_key] = entry.context
 
     st.markdown("**Context (editable):**")
     st.text_area("Edit context", st.session_state[context_key], height=180, key=context_key)
@@ -128,12 +288,23 @@ if "entries" in st.session_state:
             elif pii_val not in context_text:
                 st.error("❌ The PII value does not appear in the context. Add it to the text first.")
             else:
-                # Add the new PII
-                entry["piis"][pii_val] = {"type": new_pii_type, "relevance": new_pii_rel}
+                # Add the new PII (or overwrite an existing one)
+                if pii_val in entry.pii_values:
+                    i = entry.pii_values.index(pii_val)
+                    entry.pii_types[i] = new_pii_type
+                    entry.pii_relevances[i] = new_pii_rel
+                else:
+                    entry.pii_values.append(pii_val)
+                    entry.pii_types.append(new_pii_type)
+                    entry.pii_relevances.append(new_pii_rel)
+                    sort_pii_order(entry)
                 # Immediately refresh (Update PII list)
                 entry = refresh_pii_from_context(entry)
+                # Rows moved, so pending table edits no longer line up with them.
+                st.session_state.pop(f"piis_{idx}", None)
                 entries[idx] = entry
                 st.session_state.entries = entries
+                mark_dirty()
                 st.success(f"✅ Added PII: {pii_val} and updated PII list.")
                 st.rerun()
 
@@ -141,45 +312,49 @@ if "entries" in st.session_state:
     if st.button("🔄 Update PII list from context"):
         save_current_edits(idx, entries)
         entry = refresh_pii_from_context(entry)
+        st.session_state.pop(f"piis_{idx}", None)
         entries[idx] = entry
         st.session_state.entries = entries
+        mark_dirty()
         st.success("PIIs updated to match context.")
         st.rerun()
 
     # ---------- Preview ----------
     st.markdown("**Preview with highlights: (blue - high relevance, yellow - low relevance)**")
+    values, relevances = entry.pii_values, entry.pii_relevances
+    piis_items = tuple((values[i], relevances[i]) for i in entry.pii_order)
     st.markdown(
-        f"<div style='border:1px solid #ddd; padding:10px; border-radius:8px;'>{highlight_pii(entry['context'], entry['piis'])}</div>",
+        f"<div style='border:1px solid #ddd; padding:10px; border-radius:8px;'>{highlight_pii(entry.context, piis_items)}</div>",
         unsafe_allow_html=True
     )
 
     # ---------- Question ----------
     question_key = f"question_{idx}"
     if question_key not in st.session_state:
-        st.session_state[question_key] = entry["question"]
+        st.session_state[question_key] = entry.question
 
     st.markdown("**Question:**")
     st.text_area("Edit question", st.session_state[question_key], height=120, key=question_key)
 
     # ---------- PII Editing ----------
     st.markdown("**PIIs:**")
-    for pii, info in entry["piis"].items():
-        t_key = f"type_{idx}_{pii}"
-        r_key = f"rel_{idx}_{pii}"
-        if t_key not in st.session_state:
-            st.session_state[t_key] = info["type"]
-        if r_key not in st.session_state:
-            st.session_state[r_key] = info["relevance"]
-
-        exp_label = f"🔹 **{pii}** *({st.session_state[t_key]})*"
-        with st.expander(exp_label, expanded=False):
-            st.selectbox("Type", PII_TYPES,
-                         index=PII_TYPES.index(st.session_state[t_key])
-                         if st.session_state[t_key] in PII_TYPES else len(PII_TYPES)-1,
-                         key=t_key)
-            st.selectbox("Relevance", ["high", "low"],
-                         index=0 if st.session_state[r_key] == "high" else 1,
-                         key=r_key)
+    # One table widget for all PIIs; save_current_edits reads its edits back.
+    st.data_editor(
+        pd.DataFrame({
+            "pii": entry.pii_values,
+            "type": entry.pii_types,
+            "relevance": entry.pii_relevances,
+        }),
+        key=f"piis_{idx}",
+        column_config={
+            "pii": st.column_config.TextColumn("PII"),
+            "type": st.column_config.SelectboxColumn("Type", options=PII_TYPES, required=True),
+            "relevance": st.column_config.SelectboxColumn("Relevance", options=["high", "low"], required=True),
+        },
+        disabled=["pii"],
+        hide_index=True,
+        num_rows="fixed",
+    )
 
     # ---------- Save ----------
     if st.button("💾 Save edits"):
@@ -190,15 +365,11 @@ if "entries" in st.session_state:
     st.markdown("---")
     colA, colB = st.columns(2)
     with colA:
+        # Pull pending widget edits in first so the file matches what is on screen.
+        save_current_edits(idx, entries)
         if st.download_button(
             "⬇️ Download Updated JSONL",
-            data="\n".join(
-                json.dumps(e, ensure_ascii=False)
-                for e in (
-                    save_current_edits(st.session_state.current_idx, st.session_state.entries)
-                    or st.session_state.entries
-                )
-            ),
+            data=download_payload(entries),
             file_name="annotated.jsonl",
             mime="application/jsonl"
         ):
@@ -206,12 +377,13 @@ if "entries" in st.session_state:
 
     with colB:
         if st.button("🧩 Load Original"):
-            if "original_entries" in st.session_state:
+            if "original_entries_bytes" in st.session_state:
                 # Fully reset Streamlit session state
-                original = copy.deepcopy(st.session_state.original_entries)
+                original = st.session_state.original_entries_bytes
                 st.session_state.clear()  # ✅ wipe all widget & variable states
-                st.session_state.entries = copy.deepcopy(original)
-                st.session_state.original_entries = copy.deepcopy(original)
+                highlight_pii.clear()
+                st.session_state.entries = parse_jsonl(original)
+                st.session_state.original_entries_bytes = original
                 st.session_state.current_idx = 0
                 st.success("✅ Original data reloaded.")
                 st.rerun()